@@ -0,0 +1,86 @@
+"""Startup benchmark for scan_idl: time to import it and to run a first parse.
+
+Each run happens in a fresh interpreter so nothing is cached. The script
+also checks that importing scan_idl leaves logging alone and does not load
+pyparsing, and exits with 1 if that regresses or a time limit is exceeded.
+
+    python bench_startup.py [-n RUNS] [--max-import SECONDS] [--max-total SECONDS]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+SAMPLE = '''
+[uuid(12345678-1234-1234-1234-123456789012), helpstring("Sample"), version(1.0)]
+library Sample {
+    typedef enum Color { Red = 1, [helpstring("green")] Green, Blue = 0x10 } Color;
+    [uuid(12345678-1234-1234-1234-123456789012), dual]
+    interface ISample : IDispatch {
+        [id(1), propget, helpstring("name")] HRESULT Name([out, retval] BSTR* v);
+        [id(2)] HRESULT Run([in] long a, [in, optional] VARIANT b);
+    };
+};
+'''
+
+CHILD = '''
+import sys, json, time, logging
+start = time.perf_counter()
+import scan_idl
+imported = time.perf_counter()
+clean = (not logging.getLogger().handlers and 'pyparsing' not in sys.modules
+         and 'pdb' not in sys.modules)
+scan_idl.parseIDL(sys.stdin.read())
+parsed = time.perf_counter()
+print(json.dumps([imported - start, parsed - start, clean]))
+'''
+
+
+def run_once():
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD], input=SAMPLE, cwd=here,
+        stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--max-import', type=float, default=None,
+        help="fail if the median import time is over this many seconds")
+    parser.add_argument('--max-total', type=float, default=None,
+        help="fail if the median import + first parse time is over this "
+             "many seconds")
+    args = parser.parse_args(argv)
+
+    results = [run_once() for x in range(args.runs)]
+    imported = median([x[0] for x in results])
+    total = median([x[1] for x in results])
+    clean = all(x[2] for x in results)
+
+    print("import:               {0:8.1f} ms".format(imported * 1000))
+    print("import + first parse: {0:8.1f} ms".format(total * 1000))
+
+    failed = False
+    if not clean:
+        print("importing scan_idl configured logging or loaded pyparsing/pdb")
+        failed = True
+    if args.max_import is not None and imported > args.max_import:
+        print("import is over {0} s".format(args.max_import))
+        failed = True
+    if args.max_total is not None and total > args.max_total:
+        print("import + first parse is over {0} s".format(args.max_total))
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
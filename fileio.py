@@ -0,0 +1,160 @@
+import os
+import mmap
+import codecs
+import hashlib
+import binascii
+
+# files at least this big are memory-mapped instead of read into a bytes
+# object, so the only full copy of them is the decoded text
+MMAP_THRESHOLD = 1 << 20
+
+BOMS = [
+    # UTF-32 first, its little endian BOM starts with the UTF-16 one
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+# MIDL files without a BOM that are not UTF-8 are in the ANSI code page
+FALLBACK_ENCODING = 'cp1252'
+
+
+class WriteStats(object):
+    """Counts what happened to the output files of a run."""
+
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def update(self, other):
+        self.written += other.written
+        self.unchanged += other.unchanged
+        self.removed += other.removed
+
+    def __str__(self):
+        return "{0} written, {1} unchanged, {2} removed".format(
+            self.written, self.unchanged, self.removed)
+
+
+def detect_encoding(head):
+    """Guesses the encoding of a file from its first few bytes.
+
+    Returns the encoding named by a BOM, UTF-16 if the text has no BOM but
+    looks like UTF-16 (mostly ASCII, so every other byte is zero), and
+    otherwise None, meaning UTF-8 with FALLBACK_ENCODING as a fallback."""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+
+    even, odd = head[0::2].count(0), head[1::2].count(0)
+    if odd > len(head) // 4 and even == 0:
+        return 'utf-16-le'
+    if even > len(head) // 4 and odd == 0:
+        return 'utf-16-be'
+    return None
+
+
+def decode(buffer, encoding):
+    if encoding is not None:
+        return str(buffer, encoding), encoding
+
+    try:
+        return str(buffer, 'utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        return str(buffer, FALLBACK_ENCODING, 'replace'), FALLBACK_ENCODING
+
+
+def read_text(filename):
+    """Reads and decodes a source file. Returns (text, encoding).
+
+    Large files are memory-mapped and decoded straight out of the mapping.
+    Line endings are left as they are (the IDL grammar treats '\\r' as
+    whitespace)."""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            data = f.read()
+            return decode(data, detect_encoding(data[:64]))
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            view = memoryview(buffer)
+            try:
+                return decode(view, detect_encoding(buffer[:64]))
+            finally:
+                view.release()
+
+
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def create_temp(directory, mode):
+    """Creates a new, uniquely named file in directory and returns
+    (fd, name). The file is created with mode, less the umask, the same
+    way open() creates files."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        name = os.path.join(directory, '.tmp-' + binascii.hexlify(
+            os.urandom(6)).decode('ascii'))
+        try:
+            return os.open(name, flags, mode), name
+        except FileExistsError:
+            continue
+
+
+def write_if_changed(filename, data, stats=None):
+    """Writes data (bytes) to filename unless the file already holds it.
+
+    Changed files are written to a temporary file in the same directory and
+    renamed over the old one, so readers never see a half written file.
+    Returns True if the file was written.
+    """
+    if (os.path.isfile(filename) and
+            os.path.getsize(filename) == len(data) and
+            file_digest(filename) == hashlib.sha1(data).digest()):
+        if stats is not None:
+            stats.unchanged += 1
+        return False
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    existing = None
+    if os.path.exists(filename):
+        existing = os.stat(filename).st_mode & 0o777
+
+    fd, temp = create_temp(directory, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # keep the mode of the file being replaced
+        if existing is not None:
+            os.chmod(temp, existing)
+        os.replace(temp, filename)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+    if stats is not None:
+        stats.written += 1
+    return True
+
+
+def remove_stale(directory, ext, keep, stats=None):
+    """Removes files ending in ext directly inside directory that are not
+    in keep (a set of absolute paths)."""
+    if not os.path.isdir(directory):
+        return
+
+    for name in os.listdir(directory):
+        filename = os.path.abspath(os.path.join(directory, name))
+        if (name.endswith(ext) and os.path.isfile(filename) and
+                filename not in keep):
+            os.remove(filename)
+            if stats is not None:
+                stats.removed += 1
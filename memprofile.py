@@ -0,0 +1,105 @@
+import os
+from contextlib import contextmanager
+
+RATIO_THRESHOLD = 50
+TOP_SITES = 3
+
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if abs(size) < 1024:
+            return "{0:.1f} {1}".format(size, unit)
+        size /= 1024.0
+    return "{0:.1f} GiB".format(size)
+
+
+class MemoryProfiler(object):
+    """Measures peak memory and allocation sites of each stage of each file.
+
+    Usage:
+        profiler.begin(filename)
+        with profiler.stage('parse'):
+            ...
+
+    Each stage is measured on its own: traces are cleared when it starts,
+    so the peak is what the stage allocated on top of what was already
+    alive, and the allocation sites are those of the blocks the stage
+    allocated that were still alive when it ended. Records are plain tuples
+    so they can be sent back from worker processes.
+    """
+
+    def __init__(self, threshold=RATIO_THRESHOLD, top=TOP_SITES):
+        self.threshold = threshold
+        self.top = top
+        self.records = []
+
+    def begin(self, filename, size=None):
+        if size is None:
+            size = os.path.getsize(filename)
+        self.records.append((filename, size, []))
+
+    @contextmanager
+    def stage(self, name):
+        # tracemalloc pulls in pickle, linecache and friends; only pay for
+        # that when profiling is actually on
+        import tracemalloc
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.clear_traces()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+            sites = [
+                ("{0}:{1}".format(
+                    os.path.basename(x.traceback[0].filename),
+                    x.traceback[0].lineno), x.size, x.count)
+                for x in snapshot.statistics('lineno')[:self.top]
+            ]
+            if started:
+                tracemalloc.stop()
+            self.records[-1][2].append((name, peak, sites))
+
+    def flagged(self, record):
+        filename, size, stages = record
+        peak = max([x[1] for x in stages] or [0])
+        return peak > self.threshold * max(size, 1)
+
+    def report(self):
+        lines = []
+        for record in self.records:
+            filename, size, stages = record
+            lines.append("{0} ({1})".format(filename, format_size(size)))
+            for name, peak, sites in stages:
+                lines.append("  {0:<20} peak {1:>10}  {2:>6.1f}x input".format(
+                    name, format_size(peak), peak / float(max(size, 1))))
+                for site, site_size, count in sites:
+                    lines.append("      {0:>10}  {1:>7} blocks  {2}".format(
+                        format_size(site_size), count, site))
+            if self.flagged(record):
+                lines.append("  ! peak memory is over {0}x the input size".format(
+                    self.threshold))
+
+        flagged = [x[0] for x in self.records if self.flagged(x)]
+        lines.append("{0} of {1} files over {2}x their input size{3}".format(
+            len(flagged), len(self.records), self.threshold,
+            ": " + ", ".join(flagged) if flagged else ""))
+        return "\n".join(lines)
+
+
+@contextmanager
+def measure(profiler, name):
+    """profiler.stage(name), or nothing if profiler is None."""
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
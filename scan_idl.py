@@ -26,17 +26,14 @@
 # SOFTWARE.
 #
 import os
-import re
-import pdb
-
+import sys
 import logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+import threading
 
-from pyparsing import Word, Group, delimitedList, Literal, Keyword, Regex, \
-    alphanums, nums, quotedString, SkipTo, restOfLine, OneOrMore, ZeroOrMore,\
-    Optional, Forward, Suppress, cppStyleComment, hexnums, Combine, StringEnd,\
-    ParseException, removeQuotes
+# Only the command line entry point configures logging; pyparsing and the
+# modules used by main() are imported when they are first needed, so that
+# importing this module stays cheap for programs that embed the parser.
+logger = logging.getLogger(__name__)
 
 
 def listFiles(root_path, ext):
@@ -48,7 +45,13 @@ def listFiles(root_path, ext):
     return result
 
 
-def parseIDL(text):
+def makeParser():
+    """Builds the IDL grammar. This is the expensive part of parsing a small
+    file; use getParser() to reuse one instance."""
+    from pyparsing import Word, Group, delimitedList, Literal, Keyword, \
+        Regex, alphanums, nums, quotedString, SkipTo, restOfLine, OneOrMore, \
+        ZeroOrMore, Optional, Forward, Suppress, cppStyleComment, Combine, \
+        StringEnd, removeQuotes
 
     definitions = Forward()
 
@@ -500,28 +503,395 @@ def parseIDL(text):
     #IDL.enablePackrat()
 
     IDL("idl_file")
-    tokens = IDL.parseString(text)
+    return IDL
+
+
+idl_parser = None
+
+
+def getParser():
+    global idl_parser
+    if idl_parser is None:
+        idl_parser = makeParser()
+    return idl_parser
+
+
+# a small file that goes through every kind of definition, see warmParser()
+WARMUP_IDL = '''
+typedef [public] enum E { A = 1, [helpstring("b")] B, C = 0x2 } E;
+[uuid(00000000-0000-0000-0000-000000000000), helpstring("l"), version(1.0)]
+library L {
+    [uuid(00000000-0000-0000-0000-000000000000), dual]
+    interface I : IDispatch {
+        [id(1), propget, helpstring("p")] HRESULT P([out, retval] BSTR* v);
+        [id(2)] HRESULT M([in] long a, [in, optional] VARIANT b);
+    };
+    [uuid(00000000-0000-0000-0000-000000000000)]
+    dispinterface D { properties: methods: };
+    [uuid(00000000-0000-0000-0000-000000000000)]
+    coclass C { [default] interface I; };
+};
+'''
+
+
+def warmParser():
+    """Does the one-time work pyparsing leaves for the first parse
+    (streamlining the grammar and building its error messages and string
+    forms), so that it is not charged to whichever file is parsed first."""
+    from pyparsing import ParseBaseException
+
+    getParser().streamline()
+    for text in ['', WARMUP_IDL, 'interface']:
+        try:
+            parseIDL(text)
+        except ParseBaseException:
+            pass
+
+
+def parseIDL(text):
+    tokens = getParser().parseString(text)
 
     #print(tokens)
     return tokens
 
 
-def main():
-    logger.setLevel(logging.DEBUG)
+class ConvertOptions(object):
+    """Options for convert_many().
+
+    jobs: number of worker processes, None for one per CPU and 1 to convert
+        everything in the calling process.
+    batch_size: most inputs handed to a worker at once.
+    xml: return the asXML() string of each input.
+    models: return the transform_xml Interface and Typedef objects of each
+        input.
+    tokens: return the raw pyparsing ParseResults of each input. Off by
+        default, they are big and slow to send back from worker processes.
+    output_dir: if set, write each result's xml to this directory.
+    executor: a concurrent.futures executor to run batches on. By default
+        a process pool shared by all convert_many() calls with the same
+        number of jobs is used, so its workers only build the grammar once.
+    """
+
+    def __init__(self, jobs=None, batch_size=32, xml=True, models=True,
+                 tokens=False, output_dir=None, executor=None):
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.xml = xml
+        self.models = models
+        self.tokens = tokens
+        self.output_dir = output_dir
+        self.executor = executor
+
+
+class ConvertInput(object):
+    """IDL source text to convert. name is used for the output file when
+    writing to ConvertOptions.output_dir."""
+
+    def __init__(self, text, name=None):
+        self.text = text
+        self.name = name
+
+
+class ConvertResult(object):
+    """Outcome of converting one input.
+
+    source: the path or ConvertInput that was converted.
+    models: list of transform_xml Interface and Typedef objects.
+    xml: the asXML() string of the parse results.
+    tokens: the pyparsing ParseResults, if asked for.
+    encoding: encoding the file was read with (None for ConvertInput).
+    error: message of the error that stopped the conversion, or None.
+    timings: seconds spent in each stage ('read', 'parse', 'asXML',
+        'models').
+    output: the file the xml was written to, if any.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.models = None
+        self.xml = None
+        self.tokens = None
+        self.encoding = None
+        self.error = None
+        self.timings = {}
+        self.output = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def is_path(source):
+    return isinstance(source, (str, bytes, os.PathLike))
+
+
+def convert_one(source, xml=True, models=True, tokens=False):
+    from time import perf_counter
+    from xml.etree.ElementTree import fromstring
+    from pyparsing import ParseBaseException
+    from fileio import read_text
+
+    result = ConvertResult(source)
+    try:
+        if isinstance(source, ConvertInput):
+            text = source.text
+        elif is_path(source):
+            start = perf_counter()
+            text, result.encoding = read_text(source)
+            result.timings['read'] = perf_counter() - start
+        else:
+            raise TypeError("expected a path or a ConvertInput, got {0}".format(
+                type(source).__name__))
+
+        start = perf_counter()
+        parsed = parseIDL(text)
+        result.timings['parse'] = perf_counter() - start
+
+        if xml or models:
+            start = perf_counter()
+            data = parsed.asXML()
+            result.timings['asXML'] = perf_counter() - start
+
+        if models:
+            from transform_xml import read_models
+
+            start = perf_counter()
+            result.models = read_models(fromstring(data))
+            result.timings['models'] = perf_counter() - start
+
+        if xml:
+            result.xml = data
+        if tokens:
+            result.tokens = parsed
+    except (ParseBaseException, UnicodeDecodeError, OSError, TypeError,
+            AttributeError) as err:
+        result.error = "{0}: {1}".format(type(err).__name__, err)
+    return result
+
 
-    idl_files = listFiles('idl', '.idl')
+def convert_batch(sources, **flags):
+    return [convert_one(x, **flags) for x in sources]
 
-    for x in idl_files:
-        tokens = []
-        logger.debug(x)
-        with open(x) as f:
+
+# process pools shared by convert_many() calls, by number of workers
+worker_pools = {}
+pool_lock = threading.Lock()
+
+
+def getPool(jobs):
+    """Returns the shared process pool with jobs workers, creating it if
+    there is none yet or the last one broke (a worker died)."""
+    with pool_lock:
+        pool = worker_pools.get(jobs)
+        if pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            pool = ProcessPoolExecutor(max_workers=jobs,
+                                       initializer=getParser)
+            worker_pools[jobs] = pool
+        return pool
+
+
+def dropPool(jobs, pool):
+    """Forgets a broken shared pool, so the next getPool() makes a new one.
+    Does nothing if another thread already replaced it."""
+    with pool_lock:
+        if worker_pools.get(jobs) is pool:
+            del worker_pools[jobs]
+            pool.shutdown(wait=False)
+
+
+def run_batches(batches, flags, jobs, executor=None):
+    """Runs convert_batch() over batches on executor, or on the shared pool.
+
+    If a worker dies (e.g. killed for running out of memory) the pool is
+    broken and every batch still in it is lost. Those batches are retried
+    one at a time on a fresh pool, so only a batch that kills its worker
+    again fails; its inputs get error results instead of the whole call
+    raising."""
+    from concurrent.futures.process import BrokenProcessPool
+
+    results = [None] * len(batches)
+    errors = {}
+
+    def run(indexes):
+        pool = executor or getPool(jobs)
+        futures = {}
+        try:
+            for i in indexes:
+                futures[i] = pool.submit(convert_batch, batches[i], **flags)
+        except BrokenProcessPool as err:
+            for i in indexes:
+                errors[i] = err
+        for i, future in futures.items():
             try:
-                tokens = parseIDL(f.read())
-                with open(x + '.xml', 'w') as result:
-                    result.write(tokens.asXML())
-            except ParseException as err:
-                print(err)
+                results[i] = future.result()
+            except BrokenProcessPool as err:
+                errors[i] = err
+        if executor is None and any(results[i] is None for i in indexes):
+            dropPool(jobs, pool)
+
+    run(range(len(batches)))
+    for i in [x for x in range(len(batches)) if results[x] is None]:
+        run([i])
+
+    for i, batch in enumerate(batches):
+        if results[i] is None:
+            results[i] = [ConvertResult(x) for x in batch]
+            for result in results[i]:
+                result.error = "{0}: {1}".format(
+                    type(errors[i]).__name__, errors[i])
+    return results
+
+
+def convert_many(sources, options=None):
+    """Converts IDL files and/or ConvertInput texts, returning a
+    ConvertResult for each input, in order.
+
+    Paths may be str, bytes or os.PathLike; text has to be wrapped in a
+    ConvertInput. One parser is built per process and reused for every
+    input. With more than one input the work is split into batches of at
+    most options.batch_size inputs and run on a pool of worker processes.
+    Nothing is written unless options.output_dir is set.
+    """
+    if options is None:
+        options = ConvertOptions()
+    sources = list(sources)
+
+    outputs = None
+    if options.output_dir is not None:
+        outputs = output_names(sources, options.output_dir)
+
+    flags = dict(xml=options.xml or outputs is not None,
+                 models=options.models, tokens=options.tokens)
+
+    jobs = options.jobs or os.cpu_count() or 1
+    if options.executor is None and (jobs == 1 or len(sources) < 2):
+        results = convert_batch(sources, **flags)
+    else:
+        # small runs still get spread across all the workers
+        size = max(1, min(options.batch_size, -(-len(sources) // jobs)))
+        batches = [sources[i:i + size] for i in range(0, len(sources), size)]
+
+        results = []
+        for batch in run_batches(batches, flags, jobs, options.executor):
+            results += batch
+
+    if outputs is not None:
+        write_results(results, outputs)
+        if not options.xml:
+            for result in results:
+                result.xml = None
+    return results
+
+
+def output_names(sources, directory):
+    """Returns the file each source's xml is written to in directory.
+
+    Paths keep their location relative to the deepest directory holding all
+    of them, so inputs with the same file name in different directories
+    don't overwrite each other. A ConvertInput is written as its name, or
+    as 'input<index>.idl'. Raises ValueError if two inputs would still be
+    written to the same file."""
+    paths = [os.path.abspath(os.fsdecode(x)) for x in sources if is_path(x)]
+    root = None
+    if paths:
+        root = os.path.commonpath([os.path.dirname(x) for x in paths])
+
+    names = []
+    seen = {}
+    for i, source in enumerate(sources):
+        if isinstance(source, ConvertInput):
+            name = source.name or "input{0}.idl".format(i)
+        elif is_path(source):
+            name = os.path.relpath(os.path.abspath(os.fsdecode(source)), root)
+        else:
+            names.append(None)
+            continue
+
+        name = os.path.join(directory, name + '.xml')
+        key = os.path.normcase(os.path.normpath(name))
+        if key in seen:
+            raise ValueError("inputs {0} and {1} would both be written to "
+                             "{2}".format(seen[key], i, name))
+        seen[key] = i
+        names.append(name)
+    return names
+
+
+def write_results(results, outputs):
+    from fileio import write_if_changed
+
+    for result, output in zip(results, outputs):
+        if result.xml is None or output is None:
+            continue
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        write_if_changed(output, result.xml.encode('utf-8'))
+        result.output = output
+
+
+def main(argv=None):
+    import argparse
+    from pyparsing import ParseException
+    from fileio import WriteStats, write_if_changed, remove_stale, read_text
+    from shard import parse_shard, select_shard
+    from memprofile import MemoryProfiler, RATIO_THRESHOLD, measure
+
+    parser = argparse.ArgumentParser(
+        description="Converts the .idl files under ./idl to .idl.xml files.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="log each file as it is converted")
+    parser.add_argument('--shard', metavar='K/N', type=parse_shard,
+        default=(1, 1), help="only convert the K-th of N parts of the files")
+    parser.add_argument('--profile-memory', action='store_true',
+        help="report peak memory and top allocation sites of each stage "
+             "of each file (slow)")
+    parser.add_argument('--memory-ratio', type=float, default=RATIO_THRESHOLD,
+        help="with --profile-memory, flag files whose peak memory is over "
+             "this many times their size (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    idl_files = listFiles('idl', '.idl')
+    stats = WriteStats()
+    errors = 0
+    profiler = None
+    if args.profile_memory:
+        profiler = MemoryProfiler(args.memory_ratio)
+        # build and warm up the grammar first, so that it isn't counted
+        # against the 'parse' stage of whichever file comes first
+        warmParser()
+
+    for x in select_shard(idl_files, *args.shard):
+        tokens = []
+        if profiler is not None:
+            profiler.begin(x)
+        try:
+            with measure(profiler, 'read'):
+                text, encoding = read_text(x)
+            logger.debug("parsing %s (%s)", x, encoding)
+            with measure(profiler, 'parse'):
+                tokens = parseIDL(text)
+            with measure(profiler, 'asXML'):
+                data = tokens.asXML().encode('utf-8')
+            write_if_changed(x + '.xml', data, stats)
+        except (ParseException, UnicodeDecodeError) as err:
+            errors += 1
+            print("{0}: {1}".format(x, err))
+
+    # drop the xml of idl files that have been deleted
+    keep = set(os.path.abspath(x + '.xml') for x in idl_files)
+    for root, path, files in os.walk('idl'):
+        remove_stale(root, '.idl.xml', keep, stats)
+
+    print("files: {0}".format(stats))
+    if profiler is not None:
+        print(profiler.report())
+
+    return 1 if errors else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
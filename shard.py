@@ -0,0 +1,66 @@
+import os
+import zlib
+
+
+def parse_shard(text):
+    """Parses 'K/N' (1 <= K <= N) into (K, N)."""
+    try:
+        index, count = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise ValueError("shard must look like K/N, got {0!r}".format(text))
+    if not 1 <= index <= count:
+        raise ValueError("shard {0} is out of range".format(text))
+    return index, count
+
+
+def shard_key(path):
+    """Hash of a path that is the same on every machine and platform."""
+    path = os.path.normpath(path).replace(os.sep, '/')
+    return zlib.crc32(path.encode('utf-8'))
+
+
+def assign_shards(items, count):
+    """Splits (path, size) items into count lists of roughly equal size.
+
+    Largest items are placed first, each on the least loaded shard; ties
+    (both between items and between shards) are broken by the path hash, so
+    every machine computes the same split from the same file list.
+    """
+    shards = [[] for x in range(count)]
+    loads = [0] * count
+
+    ordered = sorted(items, key=lambda x: (-x[1], shard_key(x[0]), x[0]))
+    for path, size in ordered:
+        start = shard_key(path) % count
+        best = min(range(count),
+                   key=lambda i: (loads[i], (i - start) % count))
+        shards[best].append(path)
+        loads[best] += size
+
+    return shards
+
+
+def text_size(path):
+    """Size of a file not counting '\\r' bytes, so that a checkout with CRLF
+    line endings (git core.autocrlf on Windows) weighs the same as one
+    with LF line endings."""
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            size += len(block) - block.count(b'\r')
+    return size
+
+
+def select_shard(paths, index, count, size=text_size):
+    """Returns the paths that belong to shard index (1 based) of count,
+    in their original order.
+
+    size(path) gives the weight of a path. It must give the same answer on
+    every machine (e.g. the text_size() of a file in the checkout, not the
+    size of a generated one), or machines will disagree about the split."""
+    if count == 1:
+        return list(paths)
+
+    items = [(x, size(x)) for x in set(paths)]
+    selected = set(assign_shards(items, count)[index - 1])
+    return [x for x in paths if x in selected]
@@ -1,9 +1,19 @@
+import io
 import os
+import time
+import argparse
+from functools import partial
+from collections import OrderedDict
 import xml.etree.ElementTree as ElementTree
 ET = ElementTree
 
+from fileio import WriteStats, write_if_changed, remove_stale
+from shard import parse_shard, select_shard, text_size
+from memprofile import MemoryProfiler, RATIO_THRESHOLD, measure
+
 OUTPUT = os.path.join(os.getcwd(),'out')
 VERSION = "2011"
+MANIFEST = 'transform.manifest'
 
 class Constant(object):
     def __init__(self, xml, value=""):
@@ -216,7 +226,12 @@ def combine(xml1, xml2):
 
     return ET.ElementTree(temp)
 
-def make_interface(xml, directory):
+def add_tree(trees, output_file, tree):
+    if output_file in trees:
+        tree = combine(tree, trees[output_file])
+    trees[output_file] = tree
+
+def make_interface(xml, directory, trees):
     interface_xml = Interface(xml)
 
     output_file = os.path.join(
@@ -224,12 +239,9 @@ def make_interface(xml, directory):
         interface_xml.name + ".xml"
     )
 
-    tree = ET.ElementTree(interface_xml.toXML())
-    if os.path.exists(output_file):
-        tree = combine(tree, ET.parse(output_file))
-    tree.write(output_file)
+    add_tree(trees, output_file, ET.ElementTree(interface_xml.toXML()))
 
-def make_typedef(xml, directory):
+def make_typedef(xml, directory, trees):
     typedef = Typedef(xml)
 
     output_file = os.path.join(
@@ -237,45 +249,246 @@ def make_typedef(xml, directory):
         typedef.name + ".xml"
     )
 
-    tree = ET.ElementTree(typedef.toXML())
-    if os.path.exists(output_file):
-        print(output_file)
-        tree = combine(tree, ET.parse(output_file))
+    add_tree(trees, output_file, ET.ElementTree(typedef.toXML()))
 
-    tree.write(output_file)
-
-def parse_definitions(xml, out_dir):
+def parse_definitions(xml, out_dir, trees):
     if xml is not None:
         for interface in xml.findall('interface'):
-            make_interface(interface, out_dir)
+            make_interface(interface, out_dir, trees)
 
         for typedef in xml.findall('typedef'):
-            make_typedef(typedef, out_dir)
-
-def parse_xml(filename, output):
-    root = ElementTree.parse(filename).getroot()
-    out_dir = os.path.join(OUTPUT, output)
-
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
-    parse_definitions(root, out_dir)
-    parse_definitions(root.find('definitions'), out_dir)
-
-    for element in root.findall('library'):
-        parse_definitions(element.find('definitions'), out_dir)
-
-def main():
-    idls = [
-        ('idl/cwmfc.idl.xml', 'CWCom'),
-        ('idl/cv32old.idl.xml', 'CVScripting'),
-        ('idl/cv32def.idl.xml', 'CVScripting/Enumerators'),
-        ('idl/cv32Gateway.idl.xml', 'CVCom'),
-        ('idl/enum.idl.xml', 'CWCom/Enumerators')
-    ]
-    for idl in idls:
-        print(*idl)
-        parse_xml(*idl)
+            make_typedef(typedef, out_dir, trees)
+
+def definition_lists(root):
+    """The elements of a scanned idl xml root that can hold interfaces and
+    typedefs (some of them may be None)."""
+    return ([root, root.find('definitions')] +
+            [x.find('definitions') for x in root.findall('library')])
+
+def read_models(root):
+    """Returns the Interface and Typedef objects defined in a scanned idl
+    xml root."""
+    models = []
+    for xml in definition_lists(root):
+        if xml is not None:
+            models += [Interface(x) for x in xml.findall('interface')]
+            models += [Typedef(x) for x in xml.findall('typedef')]
+    return models
+
+def parse_xml(filename, output, trees, out_root=None, profiler=None):
+    """Adds the interfaces and typedefs in filename to trees, a dict of
+    output file -> ElementTree. Files produced more than once are merged
+    with combine()."""
+    if profiler is not None:
+        profiler.begin(filename)
+
+    with measure(profiler, 'ElementTree.parse'):
+        root = ElementTree.parse(filename).getroot()
+    out_dir = os.path.join(out_root or OUTPUT, output)
+
+    with measure(profiler, 'models'):
+        for xml in definition_lists(root):
+            parse_definitions(xml, out_dir, trees)
+
+def write_trees(trees, stats):
+    for output_file, tree in trees.items():
+        # other workers may be creating a parent directory at the same time
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+        data = io.BytesIO()
+        tree.write(data)
+        write_if_changed(output_file, data.getvalue(), stats)
+
+def read_manifest(filename):
+    """Reads (input, output_dir) pairs from a manifest file.
+
+    Each non-blank line holds an input xml file and the output directory
+    (relative to OUTPUT) separated by whitespace. Only the last field is
+    the output directory, so input paths may contain spaces (output
+    directories may not). Lines starting with '#' are comments.
+    """
+    entries = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.rsplit(None, 1)
+            if len(fields) != 2:
+                raise Exception("{0}:{1}: expected '<input> <output_dir>'".format(
+                    filename, number))
+            entries.append(tuple(fields))
+    return entries
+
+def schedule(entries):
+    """Groups manifest entries by output directory.
+
+    Entries in the same group write into the same directory and may merge
+    into the same files, so they have to run one after another (in manifest
+    order). Different groups never write the same file and can run in
+    parallel. Each entry in a group is an (index, input, output_dir) tuple,
+    index being its position in entries.
+    """
+    groups = OrderedDict()
+    for index, (filename, output) in enumerate(entries):
+        groups.setdefault(group_key(output), []).append(
+            (index, filename, output))
+    return list(groups.values())
+
+def group_key(output):
+    """Key of the group an output directory belongs to. It is the same on
+    every platform, so that --shard splits the same way everywhere."""
+    return os.path.normpath(output).replace(os.sep, '/').lower()
+
+def source_size(filename):
+    """Size (see shard.text_size) of the .idl file a scanned xml file was
+    made from.
+
+    The .idl is part of the checkout on every machine, while the xml may
+    only exist where that .idl was scanned."""
+    if filename.endswith('.idl.xml'):
+        filename = filename[:-len('.xml')]
+    return text_size(filename) if os.path.exists(filename) else 0
+
+def select_entries(entries, index, count):
+    """Returns the manifest entries that belong to shard index of count.
+
+    Entries that write the same output directory always land on the same
+    shard, so shards never produce the same file and merging their output
+    trees gives exactly the files of a single run."""
+    sizes = OrderedDict()
+    for filename, output in entries:
+        key = group_key(output)
+        sizes[key] = sizes.get(key, 0) + source_size(filename)
+
+    keys = select_shard(list(sizes), index, count, sizes.get)
+    return [x for x in entries if group_key(x[1]) in keys]
+
+def run_group(out_root, profile, entries):
+    """Runs a group of entries and writes the merged output files.
+
+    Files are only written once the whole group has been merged, and only
+    if their content changed. If profile is not None, the memory use of
+    each entry is measured with a MemoryProfiler(profile).
+
+    Returns (timings, stats, output files, memory profile records)."""
+    timings = []
+    trees = OrderedDict()
+    profiler = None
+    if profile is not None:
+        profiler = MemoryProfiler(profile)
+
+    for index, filename, output in entries:
+        start = time.perf_counter()
+        parse_xml(filename, output, trees, out_root, profiler)
+        timings.append((index, filename, output, time.perf_counter() - start))
+
+    stats = WriteStats()
+    write_trees(trees, stats)
+    return (timings, stats, [os.path.abspath(x) for x in trees],
+            profiler.records if profiler is not None else [])
+
+def run_manifest(entries, jobs=None, out_root=None, profiler=None):
+    out_root = out_root or OUTPUT
+    groups = schedule(entries)
+    timings = []
+    stats = WriteStats()
+    produced = set()
+    profile = profiler.threshold if profiler is not None else None
+
+    def collect(result):
+        timings.extend(result[0])
+        stats.update(result[1])
+        produced.update(result[2])
+        if profiler is not None:
+            profiler.records.extend(result[3])
+
+    if jobs == 1 or len(groups) < 2:
+        for group in groups:
+            collect(run_group(out_root, profile, group))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for result in pool.map(partial(run_group, out_root, profile),
+                                   groups):
+                collect(result)
+
+    # anything left in an output directory that this run did not produce
+    # is from an interface or typedef that no longer exists
+    for directory in set(os.path.join(out_root, x[1]) for x in entries):
+        remove_stale(directory, '.xml', produced, stats)
+
+    # groups finish in any order, report the entries in manifest order
+    timings.sort()
+    return [x[1:] for x in timings], stats
+
+def merge_outputs(sources, out_root, stats):
+    """Merges output trees (e.g. from separate --shard runs) into out_root.
+
+    --shard runs never write the same file, so their trees are simply
+    collected. Files found under the same relative path in more than one
+    source are merged with combine(), in the order the sources are given."""
+    trees = OrderedDict()
+    for source in sources:
+        for root, path, files in os.walk(source):
+            for name in sorted(files):
+                if not name.endswith('.xml'):
+                    continue
+                relative = os.path.relpath(os.path.join(root, name), source)
+                add_tree(trees, os.path.join(out_root, relative),
+                         ET.parse(os.path.join(root, name)))
+
+    write_trees(trees, stats)
+
+    produced = set(os.path.abspath(x) for x in trees)
+    for directory in set(os.path.dirname(x) for x in produced):
+        remove_stale(directory, '.xml', produced, stats)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Transforms scanned IDL xml files into documentation xml.")
+    parser.add_argument('manifest', nargs='?', default=MANIFEST,
+        help="file listing '<input> <output_dir>' pairs (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help="number of worker processes (default: one per CPU)")
+    parser.add_argument('-o', '--output', default=OUTPUT,
+        help="root of the output tree (default: ./out)")
+    parser.add_argument('--shard', metavar='K/N', type=parse_shard,
+        default=(1, 1), help="only run the K-th of N parts of the manifest")
+    parser.add_argument('--merge', metavar='DIR', nargs='+',
+        help="instead of running the manifest, merge the given output "
+             "trees (e.g. from --shard runs) into --output")
+    parser.add_argument('--profile-memory', action='store_true',
+        help="report peak memory and top allocation sites of each stage "
+             "of each entry (slow)")
+    parser.add_argument('--memory-ratio', type=float, default=RATIO_THRESHOLD,
+        help="with --profile-memory, flag files whose peak memory is over "
+             "this many times their size (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.merge:
+        stats = WriteStats()
+        merge_outputs(args.merge, args.output, stats)
+        print("files: {0}".format(stats))
+        return
+
+    entries = read_manifest(args.manifest)
+    entries = select_entries(entries, *args.shard)
+
+    profiler = None
+    if args.profile_memory:
+        profiler = MemoryProfiler(args.memory_ratio)
+
+    start = time.perf_counter()
+    timings, stats = run_manifest(entries, args.jobs, args.output, profiler)
+    total = time.perf_counter() - start
+
+    for filename, output, seconds in timings:
+        print("{0:8.3f}s  {1} -> {2}".format(seconds, filename, output))
+    print("{0:8.3f}s  total ({1} entries)".format(total, len(timings)))
+    print("files: {0}".format(stats))
+    if profiler is not None:
+        print(profiler.report())
 
 if __name__ == '__main__':
     main()